@@ -26,11 +26,14 @@ Features:
 
 * The body/content is not modified, all attachments are kept
 
+* An email sent to several of your SES addresses is only forwarded once
+
 * Send an error email if there was a problem sending (like body too large).
   You can test this by setting the env var TEST_LARGE_BODY, to generate a 20MB body.
   A 768MB Lambda takes 15 seconds for this test.
 
-* JSON logging.  You can run this cloudwatch logs insights query to check on your emails:
+* JSON logging.  Uses orjson if it's included in the deployment package, otherwise json.
+  You can run this cloudwatch logs insights query to check on your emails:
 
      fields @timestamp, input_event.Records.0.ses.mail.commonHeaders.from.0,
         input_event.Records.0.ses.mail.commonHeaders.subject
@@ -44,7 +47,6 @@ Other Thanks:
 
 """
 
-import unittest
 import traceback
 import json
 import os
@@ -56,6 +58,15 @@ import email.message
 import boto3
 from botocore.exceptions import ClientError
 
+# orjson is much faster for the JSON logging, but it's optional
+try:
+    import orjson
+
+    def _dumps(obj):
+        return orjson.dumps(obj).decode()
+except ImportError:
+    _dumps = json.dumps
+
 ###############################################################################
 #
 # Required configuration.  Can set here, or in environment var(s), your choice
@@ -76,35 +87,57 @@ RECIPIENT = os.getenv('MailRecipient', 'to@anywhere.com')
 ###############################################################################
 ###############################################################################
 
+# Fault injection / debugging, for testing only.  Read once, they can't change while running.
+_TEST_LARGE_BODY = bool(os.getenv("TEST_LARGE_BODY"))
+_TEST_DEBUG_BODY = bool(os.getenv("TEST_DEBUG_BODY"))
+
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
+# NB: This is dumb, but I'm doing it to stay compatible with the original version
+_KEY_PREFIX = (INCOMING_EMAIL_PREFIX + "/") if INCOMING_EMAIL_PREFIX else ""
+
+# Parsers don't keep any state between messages, so they can be shared
+_PARSER = email.parser.BytesParser(policy=email.policy.SMTP)
+_HEADER_PARSER = email.parser.BytesHeaderParser(policy=email.policy.SMTP)
+
+# boto3 clients are expensive to create, so build them once at module load where
+# Lambda amortizes the cost, and reuse them across warm invocations
+S3_CLIENT = boto3.client("s3")
+SES_CLIENT = boto3.client('ses', REGION)
+
 
 def lambda_handler(event, context):
-    logger.info(json.dumps(dict(input_event=event)))
+    # The event can be large, so only serialize it if it will actually be logged
+    if logger.isEnabledFor(logging.INFO):
+        logger.info(_dumps(dict(input_event=event)))
 
     # Get the unique ID of the message. This corresponds to the name of the file in S3.
     message_id = event['Records'][0]['ses']['mail']['messageId']
-    logger.debug(json.dumps(dict(message_id=message_id)))
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(_dumps(dict(message_id=message_id)))
 
     # Check for spam / virus
     if is_ses_spam(event):
-        logger.error(json.dumps(dict(message="rejecting spam message", message_id=message_id)))
+        logger.error(_dumps(dict(message="rejecting spam message", message_id=message_id)))
         return
 
     # These are the valid recipient(s) for your domain.
     # Any other bogus addresses in the To: header should not be present here.
     ses_recipients = get_ses_recipients(event)
 
-    # This loop is inefficient, but optimizing multiple users is not something
-    # that's a priority for me.
-    for ses_recipient in ses_recipients:
-        forward_mail(ses_recipient, message_id)
+    # Retrieve the original message from the S3 bucket.
+    raw_bytes = get_message_from_s3(message_id)
 
+    # Everything goes to the single RECIPIENT, so one send covers all of the SES recipients.
+    # The first one is used as the From address (unless SENDER is set).
+    forward_mail(ses_recipients[0], raw_bytes)
 
-def forward_mail(ses_recipient, message_id):
-    # Retrieve the original message from the S3 bucket.
-    message = get_message_from_s3(message_id)
+
+def forward_mail(ses_recipient, raw_bytes):
+    # Only the headers change, so only they are parsed.  The body is passed through as is.
+    message = parse_headers_from_bytes(raw_bytes)
+    body = get_raw_body(message)
 
     # Get the complete set of new headers.  This one function is where all the forwarding
     # logic / magic can be contained.
@@ -115,62 +148,87 @@ def forward_mail(ses_recipient, message_id):
     set_new_message_headers(message, new_headers)
 
     # For fault injection (Testing error emails)
-    if os.getenv("TEST_LARGE_BODY"):
+    if _TEST_LARGE_BODY:
         logger.info("setting a huge body")
         message.clear_content()
-        message.set_content("x" * 20000000)
+        # Short lines, so set_content() can use 7bit instead of quoted-printable encoding
+        # one giant line.  Still ~20MB, way over the SES limit.
+        message.set_content(("x" * 76 + "\n") * 260000)
+        body = None
 
-    if os.getenv("TEST_DEBUG_BODY"):
-        logger.info(json.dumps(dict(email_body=message.as_string())))
+    if _TEST_DEBUG_BODY:
+        logger.info(_dumps(dict(email_body=message.as_string())))
 
     # Send the message
     try:
-        send_raw_email(message)
+        if body is None:
+            send_raw_email(message)
+        else:
+            send_raw_email(message, build_raw_email(message, body))
     except ClientError as e:
-        logger.error("error sending forwarded email", exc_info=True)
+        # Format the traceback once, for both the log and the error email
         traceback_string = traceback.format_exc()
+        logger.error(_dumps(dict(message="error sending forwarded email", traceback=traceback_string)))
         error_message = create_error_email(message, traceback_string)
         send_raw_email(error_message)
 
 
 def get_message_from_s3(message_id):
-    # NB: This is dumb, but I'm doing it to stay compatible with the original version
-    if INCOMING_EMAIL_PREFIX:
-        object_path = (INCOMING_EMAIL_PREFIX + "/" + message_id)
-    else:
-        object_path = message_id
-
-    # Create a new S3 client.
-    client_s3 = boto3.client("s3")
+    object_path = _KEY_PREFIX + message_id
 
     # Get the email object from the S3 bucket.
-    object_s3 = client_s3.get_object(Bucket=INCOMING_EMAIL_BUCKET, Key=object_path)
-    raw_bytes = object_s3['Body'].read()
-    return parse_message_from_bytes(raw_bytes)
+    object_s3 = S3_CLIENT.get_object(Bucket=INCOMING_EMAIL_BUCKET, Key=object_path)
+
+    return object_s3['Body'].read()
 
 
 def parse_message_from_bytes(raw_bytes):
-    parser = email.parser.BytesParser(policy=email.policy.SMTP)
-    return parser.parsebytes(raw_bytes)
+    return _PARSER.parsebytes(raw_bytes)
+
+
+def parse_headers_from_bytes(raw_bytes):
+    # For decisions that only need the headers.  Stops at the blank line, so the body
+    # (and any attachments) are never parsed.
+    return _HEADER_PARSER.parsebytes(raw_bytes)
+
+
+def get_raw_body(message):
+    # The header parser leaves everything after the headers, byte for byte, as the payload.
+    # Returns it as bytes, or None if it doesn't use CRLF line endings.  The caller then
+    # serializes the whole message, which normalizes them, because SES needs CRLF.
+    body = message.get_payload().encode("ascii", "surrogateescape")
+    if body.count(b"\n") != body.count(b"\r\n"):
+        return None
+    return body
+
+
+def build_raw_email(message, body):
+    # Serialize only the (new) headers, and put the original body bytes after them.  This
+    # avoids re-encoding every MIME part of the body, which is the bulk of the message.
+    headers = b"".join(message.policy.fold_binary(name, value) for (name, value) in message.raw_items())
+    return headers + b"\r\n" + body
+
+
+# Headers we keep unchanged, keyed by lowercase name
+_KEEP_HEADERS = {header.lower(): header for header in (
+        "MIME-Version",
+        "Content-Type",
+        "Content-Disposition",
+        "Content-Transfer-Encoding",
+        "Date",
+        "Subject",
+        )}
 
 
 def get_new_message_headers(config, ses_recipient, message):
     # NB: This function shouldn't use any global vars, because we want it unit testable.
     new_headers = {}
 
-    # Headers we keep unchanged
-    headers_to_keep = [
-            "MIME-Version",
-            "Content-Type",
-            "Content-Disposition",
-            "Content-Transfer-Encoding",
-            "Date",
-            "Subject",
-            ]
-
-    for header in headers_to_keep:
-        if header in message:
-            new_headers[header] = message[header]
+    # Headers we keep unchanged.  Walk the raw headers once, and only parse the ones we keep.
+    for (name, value) in message.raw_items():
+        header = _KEEP_HEADERS.get(name.lower())
+        if header and header not in new_headers:
+            new_headers[header] = message.policy.header_fetch_parse(name, value)
 
     # Headers we customize for forwarding logic
     new_headers["To"] = config["recipient"]
@@ -189,9 +247,11 @@ def get_new_message_headers(config, ses_recipient, message):
 
 
 def set_new_message_headers(message, new_headers):
-    # Clear all headers
-    for header in message.keys():
-        del message[header]
+    # Clear all headers.  CPython's email.message.Message keeps them as a plain list of
+    # (name, value) tuples in _headers, and each `del message[name]` rescans that whole
+    # list, so reset it directly rather than deleting one header at a time.
+    message._headers = []
+    message._unixfrom = None
     for (name, value) in new_headers.items():
         message[name] = value
 
@@ -226,78 +286,24 @@ def get_ses_recipients(event):
 def is_ses_spam(event):
     receipt = event['Records'][0]['ses']['receipt']
     verdicts = ['spamVerdict', 'virusVerdict', 'spfVerdict', 'dkimVerdict', 'dmarcVerdict']
-    is_fail = False
     for verdict in verdicts:
-        if verdict in receipt:
-            status = receipt[verdict].get("status")
-            logger.debug(json.dumps(dict(verdict=verdict, status=status)))
-            if status == "FAIL":
-                is_fail = True
-    return is_fail
-
-
-def send_raw_email(message):
-    client_ses = boto3.client('ses', REGION)
-    response = client_ses.send_raw_email(
+        status = receipt.get(verdict, {}).get("status")
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(_dumps(dict(verdict=verdict, status=status)))
+        if status == "FAIL":
+            return True
+    return False
+
+
+def send_raw_email(message, data=None):
+    if data is None:
+        data = message.as_bytes()
+    response = SES_CLIENT.send_raw_email(
             Source=message['From'],
             Destinations=[message['To']],
             RawMessage={
-                'Data': message.as_string()
+                'Data': data
                 }
             )
-    print("Email sent! MessageId:", response['MessageId'])
-
-
-
-class UnitTests(unittest.TestCase):
-    def test_multiple_recipients(self):
-        with open("tests/multiple_recipients.txt", "rb") as f:
-            text = f.read()
-        message = parse_message_from_bytes(text)
-        # This is why we shouldn't trust the original To header,
-        # it can have all kind of junk
-        self.assertEqual(len(message["To"].addresses), 3)
-
-    def test_header_changes(self):
-        with open("tests/multiple_recipients.txt", "rb") as f:
-            text = f.read()
-        message = parse_message_from_bytes(text)
-        ses_recipient = "code@coder.dev"
-        config = dict(sender="", recipient="someone@secret.com")
-        new_headers = get_new_message_headers(config, ses_recipient, message)
-        self.assertEqual(new_headers["To"], "someone@secret.com")
-        self.assertEqual(new_headers["From"], "code@coder.dev")
-        self.assertEqual(new_headers["Subject"], "test 3 addresses")
-        self.assertEqual(new_headers["Reply-To"], "Alpha Sigma <user@users.com>")
-        self.assertEqual("Content-Disposition" in new_headers, False)
-
-        config = dict(sender="fixed@coder.dev", recipient="someone@secret.com")
-        new_headers = get_new_message_headers(config, ses_recipient, message)
-        self.assertEqual(new_headers["To"], "someone@secret.com")
-        self.assertEqual(new_headers["From"], "fixed@coder.dev")
-
-    def test_header_changes2(self):
-        with open("tests/reply_to.txt", "rb") as f:
-            text = f.read()
-        message = parse_message_from_bytes(text)
-        ses_recipient = "code@coder.dev"
-        config = dict(sender="", recipient="someone@secret.com")
-        new_headers = get_new_message_headers(config, ses_recipient, message)
-        self.assertEqual(new_headers["Subject"], "test reply-to")
-        self.assertEqual(new_headers["Reply-To"], "My Alias <alias@alias.com>")
-
-        set_new_message_headers(message, new_headers)
-        self.assertEqual(message["From"], "code@coder.dev")
-        self.assertEqual(message["To"], "someone@secret.com")
-        self.assertEqual(message["Subject"], "test reply-to")
-        self.assertEqual(message["Reply-To"], "My Alias <alias@alias.com>")
-
-    def test_event_parsing(self):
-        with open("tests/event.json", "rb") as f:
-            event = json.load(f)
-        self.assertEqual(is_ses_spam(event), True)
-        self.assertEqual(get_ses_recipients(event), ['code@coder.dev', 'code2@coder.dev'])
-
-
-if __name__ == '__main__':
-    unittest.main()
+    if logger.isEnabledFor(logging.INFO):
+        logger.info(_dumps(dict(message="email sent", message_sent_id=response['MessageId'])))
@@ -0,0 +1,158 @@
+import unittest
+import json
+
+from humble_forwarder import (
+        parse_message_from_bytes,
+        parse_headers_from_bytes,
+        get_raw_body,
+        build_raw_email,
+        get_new_message_headers,
+        set_new_message_headers,
+        create_error_email,
+        get_ses_recipients,
+        is_ses_spam,
+        )
+
+
+class UnitTests(unittest.TestCase):
+    def test_multiple_recipients(self):
+        with open("tests/multiple_recipients.txt", "rb") as f:
+            text = f.read()
+        message = parse_message_from_bytes(text)
+        # This is why we shouldn't trust the original To header,
+        # it can have all kind of junk
+        self.assertEqual(len(message["To"].addresses), 3)
+
+    def test_parse_headers_only(self):
+        with open("tests/multiple_recipients.txt", "rb") as f:
+            text = f.read()
+        message = parse_headers_from_bytes(text)
+        self.assertEqual(message["Subject"], "test 3 addresses")
+        self.assertEqual(len(message["To"].addresses), 3)
+
+    def test_header_changes(self):
+        with open("tests/multiple_recipients.txt", "rb") as f:
+            text = f.read()
+        message = parse_message_from_bytes(text)
+        ses_recipient = "code@coder.dev"
+        config = dict(sender="", recipient="someone@secret.com")
+        new_headers = get_new_message_headers(config, ses_recipient, message)
+        self.assertEqual(new_headers["To"], "someone@secret.com")
+        self.assertEqual(new_headers["From"], "code@coder.dev")
+        self.assertEqual(new_headers["Subject"], "test 3 addresses")
+        self.assertEqual(new_headers["Reply-To"], "Alpha Sigma <user@users.com>")
+        self.assertEqual("Content-Disposition" in new_headers, False)
+
+        config = dict(sender="fixed@coder.dev", recipient="someone@secret.com")
+        new_headers = get_new_message_headers(config, ses_recipient, message)
+        self.assertEqual(new_headers["To"], "someone@secret.com")
+        self.assertEqual(new_headers["From"], "fixed@coder.dev")
+
+    def test_header_changes2(self):
+        with open("tests/reply_to.txt", "rb") as f:
+            text = f.read()
+        message = parse_message_from_bytes(text)
+        ses_recipient = "code@coder.dev"
+        config = dict(sender="", recipient="someone@secret.com")
+        new_headers = get_new_message_headers(config, ses_recipient, message)
+        self.assertEqual(new_headers["Subject"], "test reply-to")
+        self.assertEqual(new_headers["Reply-To"], "My Alias <alias@alias.com>")
+
+        set_new_message_headers(message, new_headers)
+        self.assertEqual(message["From"], "code@coder.dev")
+        self.assertEqual(message["To"], "someone@secret.com")
+        self.assertEqual(message["Subject"], "test reply-to")
+        self.assertEqual(message["Reply-To"], "My Alias <alias@alias.com>")
+
+    def test_raw_body_passthrough(self):
+        with open("tests/multiple_recipients.txt", "rb") as f:
+            text = f.read().replace(b"\n", b"\r\n")
+        message = parse_headers_from_bytes(text)
+        body = get_raw_body(message)
+        self.assertEqual(body, b"Test 3 addresses\r\n")
+
+        config = dict(sender="", recipient="someone@secret.com")
+        new_headers = get_new_message_headers(config, "code@coder.dev", message)
+        set_new_message_headers(message, new_headers)
+        data = build_raw_email(message, body)
+        self.assertTrue(data.endswith(b"\r\n\r\n" + body))
+        self.assertEqual(data.count(b"\n"), data.count(b"\r\n"))
+
+        # Same result as parsing and re-serializing the whole message
+        full_message = parse_message_from_bytes(text)
+        set_new_message_headers(full_message, new_headers)
+        self.assertEqual(data, full_message.as_bytes())
+
+    def test_raw_body_lf_line_endings(self):
+        # SES needs CRLF, so LF messages go through the full serializer, which converts them
+        with open("tests/multiple_recipients.txt", "rb") as f:
+            text = f.read()
+        message = parse_headers_from_bytes(text)
+        self.assertIsNone(get_raw_body(message))
+
+        config = dict(sender="", recipient="someone@secret.com")
+        new_headers = get_new_message_headers(config, "code@coder.dev", message)
+        set_new_message_headers(message, new_headers)
+        data = message.as_bytes()
+        self.assertTrue(data.endswith(b"\r\n\r\nTest 3 addresses\r\n"))
+        self.assertEqual(data.count(b"\n"), data.count(b"\r\n"))
+
+    def test_raw_body_missing_separator(self):
+        # The header parser stops at the bogus line, so everything after it is body
+        text = (b"Subject: x\r\nFrom: a@a.com\r\nContent-Type: text/plain\r\n"
+                b"bogus header line\r\nTo: b@b.com\r\n\r\nreal body\r\n")
+        message = parse_headers_from_bytes(text)
+        body = get_raw_body(message)
+        self.assertEqual(body, b"bogus header line\r\nTo: b@b.com\r\n\r\nreal body\r\n")
+
+        config = dict(sender="", recipient="someone@secret.com")
+        new_headers = get_new_message_headers(config, "code@coder.dev", message)
+        set_new_message_headers(message, new_headers)
+        self.assertTrue(build_raw_email(message, body).endswith(b"\r\n\r\n" + body))
+
+    def test_raw_body_leading_blank_line(self):
+        # No headers at all, the blank line ends them right away
+        text = b"\r\nline1\r\n\r\nline2\r\n"
+        message = parse_headers_from_bytes(text)
+        self.assertEqual(get_raw_body(message), b"line1\r\n\r\nline2\r\n")
+
+    def test_error_email(self):
+        with open("tests/reply_to.txt", "rb") as f:
+            text = f.read()
+        message = parse_message_from_bytes(text)
+        message.replace_header("Subject", "caf\u00e9")
+        error_message = create_error_email(message, "Traceback: boom")
+        self.assertEqual(error_message["Subject"], "Email forwarding error")
+        self.assertEqual(error_message["Content-Transfer-Encoding"], "8bit")
+
+        error_message = parse_message_from_bytes(error_message.as_bytes())
+        content = error_message.get_content()
+        self.assertIn("Original Subject: caf\u00e9", content)
+        self.assertIn("Traceback: boom", content)
+
+    def test_error_email_long_lines(self):
+        with open("tests/reply_to.txt", "rb") as f:
+            text = f.read()
+        message = parse_message_from_bytes(text)
+        message.replace_header("Subject", "s" * 1200)
+        traceback_string = ("botocore.exceptions.ClientError: An error occurred (InvalidParameterValue) "
+                            "when calling the SendRawEmail operation: Message length is more than 10485760 bytes long")
+        error_message = create_error_email(message, traceback_string)
+        self.assertNotIn(error_message["Content-Transfer-Encoding"], ("7bit", "8bit"))
+
+        data = error_message.as_bytes()
+        self.assertTrue(all(len(line) <= 998 for line in data.split(b"\r\n")))
+
+        content = parse_message_from_bytes(data).get_content()
+        self.assertIn("Original Subject: " + "s" * 1200, content)
+        self.assertIn(traceback_string, content)
+
+    def test_event_parsing(self):
+        with open("tests/event.json", "rb") as f:
+            event = json.load(f)
+        self.assertEqual(is_ses_spam(event), True)
+        self.assertEqual(get_ses_recipients(event), ['code@coder.dev', 'code2@coder.dev'])
+
+
+if __name__ == '__main__':
+    unittest.main()